@@ -25,8 +25,7 @@ class ContextPlugin(object):
         if self.active:
             current = coverage.Coverage.current()
             if current is not None:
-                context = "{item.nodeid}|{when}".format(item=item, when=when)
-                current.switch_context(context)
+                current.switch_context(f"{item.nodeid}|{when}")
 
 
 @pytest.hookimpl(tryfirst=True)
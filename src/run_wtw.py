@@ -1,12 +1,13 @@
 from collections import defaultdict
+from itertools import compress
 import os
 import os.path
+import numpy as np
 import pytest
+import re
 import sqlite3
-import sys
 
 from _pytest.pathlib import Path
-from unidiff import PatchSet
 
 
 class WTWPlugin(object):
@@ -17,92 +18,122 @@ class WTWPlugin(object):
         self.active = all(config.getoption(opt) for opt in ("wtw", "wtwdb"))
         if self.active:
             wtw_path = config.getoption("wtw")
-            with open(wtw_path) as wtw_file:
-                self.diff = PatchSet(wtw_file, encoding='utf-8')
-            self.baseline = sqlite3.connect(config.getoption("wtwdb"))
-            self.baseline.create_function("any_intersection", 2, any_intersection)
+            with open(wtw_path, encoding="utf-8") as wtw_file:
+                self.diff = parse_diff_hunks(wtw_file)
+            # The baseline is the user's coverage data; only ever read it.
+            baseline_path = os.path.abspath(config.getoption("wtwdb"))
+            self.baseline = sqlite3.connect(
+                Path(baseline_path).as_uri() + "?mode=ro", uri=True
+            )
         self._skipped_files = 0
         self._report_status = None
+        self._ignore_cache = {}
 
     def who_tested_what(self):
         """
-        Returns a nested dict of files -> classes -> functions.
+        Returns a tuple of (files_changed, context_files, contexts, paths_changed).
 
-        If the file maps to None, then the whole file should be run.
+        files_changed and context_files are absolute path strings of the files
+        touched by the diff and of the test files that cover the changed lines.
+        contexts is the set of test node ids that cover the changed lines, and
+        paths_changed holds the changed files as rootdir-relative strings,
+        comparable with the file part of a node id.
         """
         try:
             return self._who_tested_what
         except AttributeError:
-            rootpath = Path(self.config.rootdir)
+            # These paths are only ever compared as strings, so build them as
+            # strings rather than as Path objects.
+            rootpath = str(Path(self.config.rootdir)) + os.sep
             files_changed = set()
-            source_lines_changed = defaultdict(set)
-
-            for file in self.diff:
-                files_changed.add(rootpath / file.path)
-                for hunk in file:
-                    source_lines_changed[file.path].update(
-                        range(
-                            hunk.source_start - 1,
-                            hunk.source_start + hunk.source_length + 1,
-                        )
-                    )
+            paths_changed = set()
+            source_lines_changed = defaultdict(list)
 
-            source_line_masks = [
-                (os.path.abspath(file_path), buffer(set_to_bitmask(lines)))
-                for file_path, lines in source_lines_changed.items()
-            ]
-
-            with self.baseline as cursor:
-                cursor.execute("""DROP TABLE IF EXISTS diff_lines""")
-                cursor.execute(
-                    """
-                    CREATE TABLE diff_lines(
-                        path TEXT,
-                        linemask BLOB
+            # Tests are selected by the files as they are now, but the baseline
+            # measured them under their names before the change.
+            for file_path, (source_path, hunks) in self.diff.items():
+                files_changed.add(rootpath + file_path.replace("/", os.sep))
+                paths_changed.add(file_path)
+                if source_path is None:
+                    continue
+                for source_start, source_length in hunks:
+                    source_lines_changed[source_path].append(
+                        np.arange(
+                            source_start - 1,
+                            source_start + source_length + 1,
+                            dtype=np.int64,
+                        )
                     )
-                    """
-                )
-                cursor.executemany(
-                    "INSERT INTO diff_lines VALUES (?, ?)", source_line_masks
-                )
 
-            with self.baseline as cursor:
-                all_files = []
-                for (abspath,) in cursor.execute(
-                    """
-                    SELECT DISTINCT f.path
-                    FROM file f
-                    """
-                ):
-                    all_files.append(abspath)
-                common_prefix = os.path.commonprefix(all_files)
-                if not common_prefix.endswith("/"):
-                    common_prefix = os.path.dirname(common_prefix)
+            source_line_masks = {
+                os.path.abspath(source_path): set_to_bitmask(np.concatenate(lines))
+                for source_path, lines in source_lines_changed.items()
+            }
 
             contexts = set()
             context_files = set()
-            with self.baseline as cursor:
-                for (context,) in cursor.execute(
+            cursor = self.baseline.cursor()
+            cursor.arraysize = FETCH_SIZE
+            # Only the rows for the changed files are pulled out of SQLite,
+            # and the bitmaps are compared here against the diff masks.  Both
+            # lookups seek through the indexes SQLite builds for coverage's
+            # unique (path) on file and unique (file_id, context_id) on
+            # line_map, so no indexes of our own are needed.
+            file_masks = {
+                file_id: source_line_masks[path]
+                for rows in select_in(
+                    cursor,
+                    "SELECT id, path FROM file WHERE path IN ({})",
+                    source_line_masks,
+                )
+                for (file_id, path) in rows
+            }
+            context_ids = set()
+            for file_id, mask in file_masks.items():
+                rows = cursor.execute(
                     """
-                    SELECT DISTINCT c.context
-                    FROM diff_lines dl
-                    JOIN file f
-                    ON dl.path = f.path
-                    JOIN line_map l
-                    ON any_intersection(dl.linemask, l.bitmap)
-                    AND l.file_id = f.id
-                    JOIN context c
-                    ON l.context_id = c.id
-                    WHERE
-                        c.context <> ''
+                    SELECT context_id, bitmap
+                    FROM line_map
+                    WHERE file_id = ?
                     """,
-                ):
-                    specifier, _, calltype = context.rpartition("|")
+                    (file_id,),
+                ).fetchall()
+                if rows:
+                    file_context_ids, bitmaps = zip(*rows)
+                    hits = intersecting_bitmaps(mask, bitmaps)
+                    context_ids.update(compress(file_context_ids, hits))
+
+            add_context = contexts.add
+            add_context_file = context_files.add
+            for rows in select_in(
+                cursor,
+                "SELECT context FROM context WHERE id IN ({}) AND context <> ''",
+                context_ids,
+            ):
+                for (context,) in rows:
+                    # Contexts are "nodeid|when", and when is one of the phases
+                    # that ContextPlugin records, so strip those without splitting.
+                    if context.endswith("|call"):
+                        specifier = context[:-5]
+                    elif context.endswith("|setup"):
+                        specifier = context[:-6]
+                    elif context.endswith("|teardown"):
+                        specifier = context[:-9]
+                    else:
+                        specifier = context.rpartition("|")[0]
                     filepath, _, _ = specifier.partition("::")
-                    context_files.add(rootpath / filepath)
-                    contexts.add(specifier)
+                    add_context_file(rootpath + filepath.replace("/", os.sep))
+                    add_context(specifier)
 
-            self._who_tested_what = (files_changed, context_files, contexts)
+            self._who_tested_what = (
+                files_changed,
+                context_files,
+                frozenset(contexts),
+                frozenset(paths_changed),
+            )
+            # pytest_ignore_collect checks every collected file against these,
+            # so keep the union ready as strings rather than rebuild it per call.
+            self._all_test_files = frozenset(files_changed | context_files)
         return self._who_tested_what
 
     def pytest_ignore_collect(self, path):
@@ -110,13 +141,22 @@ class WTWPlugin(object):
         Ignore this file path if we are in --wtw mode and it is not in the list of
         files to test.
         """
-        if self.active and self.config.getoption("wtw") and path.isfile():
-            (files_changed, context_files, _) = self.who_tested_what()
-            if Path(path) not in (files_changed | context_files):
-                self._skipped_files += 1
-                return True
-            else:
-                return False
+        if self.active:
+            # pytest can ask about the same path more than once; remember the
+            # answer so neither the isfile() stat nor the skip count repeats.
+            path_str = str(path)
+            try:
+                return self._ignore_cache[path_str]
+            except KeyError:
+                pass
+            ignore = None
+            if path.isfile():
+                self.who_tested_what()
+                ignore = path_str not in self._all_test_files
+                if ignore:
+                    self._skipped_files += 1
+            self._ignore_cache[path_str] = ignore
+            return ignore
 
     def pytest_report_collectionfinish(self):
         if self.active and self.config.getoption("verbose") >= 0:
@@ -126,18 +166,21 @@ class WTWPlugin(object):
         if not self.active:
             return
 
-        (files_changed, _, contexts) = self.who_tested_what()
+        (_, _, contexts, paths_changed) = self.who_tested_what()
 
-        selected_items = [
-            item
-            for item in items
-            if item.nodeid in contexts
-            or any(
-                Path(item.nodeid.partition("::")[0]) == changed_file for changed_file in files_changed
-            )
-        ]
-        selected_set = set(selected_items)
-        skipped_items = [item for item in items if item not in selected_set]
+        # This runs once per collected item, so keep the loop body to local
+        # lookups and a single split of the node id, and sort each item into
+        # selected or skipped in the same pass.
+        selected_items = []
+        skipped_items = []
+        select = selected_items.append
+        skip = skipped_items.append
+        for item in items:
+            nodeid = item.nodeid
+            if nodeid in contexts or nodeid.partition("::")[0] in paths_changed:
+                select(item)
+            else:
+                skip(item)
 
         items[:] = selected_items
         config.hook.pytest_deselected(items=skipped_items)
@@ -177,15 +220,151 @@ def pytest_addoption(parser):
     )
 
 
+# SQLite's default limit on the number of ? parameters in a statement for
+# versions before 3.32.
+MAX_SQL_VARIABLES = 999
+
+# How many result rows to fetch from SQLite at a time.
+FETCH_SIZE = 1024
+
+
+def select_in(cursor, sql, values):
+    """
+    Run a query with an "IN ({})" clause filled in from `values`.
+
+    The values are sent in batches small enough for SQLite's parameter limit,
+    and the results are yielded as lists of up to cursor.arraysize rows, so
+    callers can loop over them without a generator step per row.
+    """
+    values = list(values)
+    for start in range(0, len(values), MAX_SQL_VARIABLES):
+        batch = values[start:start + MAX_SQL_VARIABLES]
+        cursor.execute(sql.format(", ".join("?" * len(batch))), batch)
+        rows = cursor.fetchmany()
+        while rows:
+            yield rows
+            rows = cursor.fetchmany()
+
+
+DEV_NULL = "/dev/null"
+DIFF_GIT_HEADER = re.compile(r"^diff --git ([abciow12]/[^\t]+) ([abciow12]/[^\t]+)$")
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,(\d+))? @@")
+PATH_PREFIX = re.compile(r"^[abciow12]/")
+
+
+def parse_diff_hunks(lines):
+    """
+    Scan a unified diff for the files it touches and the source lines changed.
+
+    Returns a dict mapping the path of each file in the diff, as it is after the
+    change, to a pair (source_path, hunks).  source_path is the file's path
+    before the change: it differs for a rename and is None for a new file.  A
+    deleted file is keyed by its source path.  hunks is a list of
+    (source_start, source_length) pairs, one per hunk.
+
+    A "diff --git" header starts a file, and its "new file", "deleted file" and
+    "rename from/to" lines refine the names, so renames, mode changes and empty
+    files are reported even with no hunks.  Plain diffs start a file at their
+    --- header.  Hunk bodies are just counted off so that their lines are never
+    mistaken for headers.
+    """
+    files = []
+    current = None  # [source, target, hunks] for the file being read.
+    in_git_header = expect_target = False
+    source_left = target_left = 0
+    for line in lines:
+        if source_left > 0 or target_left > 0:
+            tag = line[:1]
+            if tag == "-":
+                source_left -= 1
+            elif tag == "+":
+                target_left -= 1
+            elif tag != "\\":
+                source_left -= 1
+                target_left -= 1
+            continue
+
+        line = line.rstrip("\r\n")
+        git_header = DIFF_GIT_HEADER.match(line)
+        if git_header:
+            source, target = git_header.groups()
+            current = [_strip_prefix(source), _strip_prefix(target), []]
+            files.append(current)
+            in_git_header = True
+        elif line.startswith("--- "):
+            if not in_git_header:
+                current = [None, None, []]
+                files.append(current)
+            current[0] = _diff_filename(line)
+            in_git_header = False
+            expect_target = True
+        elif line.startswith("+++ ") and expect_target:
+            current[1] = _diff_filename(line)
+            expect_target = False
+        elif in_git_header:
+            if line.startswith("new file mode "):
+                current[0] = DEV_NULL
+            elif line.startswith("deleted file mode "):
+                current[1] = DEV_NULL
+            elif line.startswith("rename from "):
+                current[0] = line[len("rename from "):]
+            elif line.startswith("rename to "):
+                current[1] = line[len("rename to "):]
+        elif current is not None and not expect_target:
+            match = HUNK_HEADER.match(line)
+            if match:
+                source_start, source_length, target_length = match.groups()
+                source_left = 1 if source_length is None else int(source_length)
+                target_left = 1 if target_length is None else int(target_length)
+                current[2].append((int(source_start), source_left))
+
+    diff = {}
+    for source, target, hunks in files:
+        path = source if target in (None, DEV_NULL) else target
+        diff[path] = (None if source == DEV_NULL else source, hunks)
+    return diff
+
+
+def _diff_filename(line):
+    """The file name from a ---/+++ header line, without timestamp or prefix."""
+    return _strip_prefix(line[4:].partition("\t")[0])
+
+
+def _strip_prefix(filename):
+    """Remove a diff's a/, b/ (or other one-letter) prefix from a file name."""
+    if PATH_PREFIX.match(filename):
+        return filename[2:]
+    return filename
+
+
 def set_to_bitmask(nums):
-    nbytes = max(nums) // 8 + 1
-    b = bytearray(nbytes)
-    for num in nums:
-        b[num//8] |= 1 << num % 8
-    return bytes(b)
-
-if sys.version_info < (3, 0):
-    def any_intersection(bits1, bits2):
-        from itertools import izip_longest
-        byte_pairs = izip_longest(bits1, bits2, fillvalue='\x00')
-        return int(any((ord(b1) & ord(b2)) for b1, b2 in byte_pairs))
+    """
+    Pack non-negative ints into a little-endian bitmask.
+
+    `nums` can be a NumPy integer array, which is used as is, or any other
+    sized collection of ints.  Duplicates are fine.
+    """
+    if isinstance(nums, np.ndarray):
+        arr = nums
+    else:
+        arr = np.fromiter(nums, dtype=np.int64, count=len(nums))
+    bits = np.zeros(arr.max() + 1, dtype=bool)
+    bits[arr] = True
+    return np.packbits(bits, bitorder="little").tobytes()
+
+
+def intersecting_bitmaps(mask, bitmaps):
+    """
+    Which of `bitmaps` share a set bit with `mask`?
+
+    All are bitmasks as produced by set_to_bitmask.  Returns a boolean NumPy
+    array with one entry per bitmap.  Only the first len(mask) bytes of a
+    bitmap can intersect, so each is cut or padded to that length and the
+    whole stack is ANDed with the mask at once.
+    """
+    nbytes = len(mask)
+    matrix = np.frombuffer(
+        b"".join(bitmap[:nbytes].ljust(nbytes, b"\0") for bitmap in bitmaps),
+        dtype=np.uint8,
+    ).reshape(-1, nbytes)
+    return (matrix & np.frombuffer(mask, dtype=np.uint8)).any(axis=1)
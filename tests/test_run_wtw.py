@@ -0,0 +1,166 @@
+# Licensed under the Apache License: http://www.apache.org/licenses/LICENSE-2.0
+# For details: https://github.com/nedbat/coverage_pytest_plugin/blob/master/NOTICE.txt
+
+"""Tests for the diff scanning in run_wtw."""
+
+import textwrap
+
+from coverage_pytest_plugin.run_wtw import parse_diff_hunks
+
+
+def parse(diff_text):
+    return parse_diff_hunks(textwrap.dedent(diff_text).splitlines(True))
+
+
+def test_edited_file():
+    diff = parse("""\
+        diff --git a/pkg/mod.py b/pkg/mod.py
+        index 1c943a9..36ef1ba 100644
+        --- a/pkg/mod.py
+        +++ b/pkg/mod.py
+        @@ -10,3 +10,4 @@ def f():
+         a
+        -b
+        +c
+        +d
+         e
+        @@ -40,2 +41,2 @@
+        -x
+        +y
+         z
+        """)
+    assert diff == {"pkg/mod.py": ("pkg/mod.py", [(10, 3), (40, 2)])}
+
+
+def test_renamed_and_edited_file():
+    diff = parse("""\
+        diff --git a/test_new.py b/test_renamed.py
+        similarity index 51%
+        rename from test_new.py
+        rename to test_renamed.py
+        index d6a29c3..d3e30e9 100644
+        --- a/test_new.py
+        +++ b/test_renamed.py
+        @@ -1,2 +1,2 @@
+         def test_a():
+        -    assert 1
+        +    assert 2
+        """)
+    assert diff == {"test_renamed.py": ("test_new.py", [(1, 2)])}
+
+
+def test_files_without_hunks():
+    diff = parse("""\
+        diff --git a/empty.py b/empty.py
+        new file mode 100644
+        index 0000000..e69de29
+        diff --git a/mode.py b/mode.py
+        old mode 100644
+        new mode 100755
+        diff --git a/moved.py b/moved2.py
+        similarity index 100%
+        rename from moved.py
+        rename to moved2.py
+        """)
+    assert diff == {
+        "empty.py": (None, []),
+        "mode.py": ("mode.py", []),
+        "moved2.py": ("moved.py", []),
+    }
+
+
+def test_new_and_deleted_files():
+    diff = parse("""\
+        diff --git a/gone.py b/gone.py
+        deleted file mode 100644
+        index f3ae1fa..0000000
+        --- a/gone.py
+        +++ /dev/null
+        @@ -1 +0,0 @@
+        -gone = 1
+        diff --git a/added.py b/added.py
+        new file mode 100644
+        index 0000000..f3ae1fa
+        --- /dev/null
+        +++ b/added.py
+        @@ -0,0 +1 @@
+        +added = 1
+        """)
+    assert diff == {
+        "gone.py": ("gone.py", [(1, 1)]),
+        "added.py": (None, [(0, 0)]),
+    }
+
+
+def test_zero_context_hunks():
+    diff = parse("""\
+        diff --git a/mod.py b/mod.py
+        index 1c943a9..36ef1ba 100644
+        --- a/mod.py
+        +++ b/mod.py
+        @@ -2 +2 @@ a
+        -b
+        +B
+        @@ -7,0 +8,2 @@ def g():
+        +new1
+        +new2
+        @@ -20,3 +22,0 @@
+        -old1
+        -old2
+        -old3
+        """)
+    assert diff == {"mod.py": ("mod.py", [(2, 1), (7, 0), (20, 3)])}
+
+
+def test_no_newline_marker():
+    diff = parse("""\
+        diff --git a/nonl.py b/nonl.py
+        index 1c943a9..36ef1ba 100644
+        --- a/nonl.py
+        +++ b/nonl.py
+        @@ -1,3 +1,3 @@
+         a
+        -b
+        +B
+         c
+        \\ No newline at end of file
+        diff --git a/other.py b/other.py
+        index 1c943a9..36ef1ba 100644
+        --- a/other.py
+        +++ b/other.py
+        @@ -5,2 +5,2 @@
+        -c
+        \\ No newline at end of file
+        +C
+        \\ No newline at end of file
+        """)
+    assert diff == {
+        "nonl.py": ("nonl.py", [(1, 3)]),
+        "other.py": ("other.py", [(5, 2)]),
+    }
+
+
+def test_timestamped_headers():
+    diff = parse("""\
+        --- orig/mod.py\t2019-06-01 10:00:00.000000000 -0400
+        +++ mod.py\t2019-06-02 11:30:00.000000000 -0400
+        @@ -3,2 +3,2 @@
+        -a
+        +b
+         c
+        """)
+    assert diff == {"mod.py": ("orig/mod.py", [(3, 2)])}
+
+
+def test_hunk_lines_that_look_like_headers():
+    diff = parse("""\
+        diff --git a/mod.py b/mod.py
+        index 1c943a9..36ef1ba 100644
+        --- a/mod.py
+        +++ b/mod.py
+        @@ -1,2 +1,2 @@
+        --- not a header
+        +++ b/not/a/header
+         diff --git a/x b/x
+        """)
+    assert diff == {"mod.py": ("mod.py", [(1, 2)])}